@@ -0,0 +1,219 @@
+"""
+Asynchronous micro-batching queue placed in front of the VLM generation call.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+
+
+class AdaptiveBatchCollator:
+    """
+    Groups pending requests into buckets of similar image size.
+
+    Images are keyed by ``(round(height / bucket_size), round(width / bucket_size))``,
+    so a batch only mixes images whose patch grids match. The model decodes the
+    samples of a batch one after another, so nothing is padded either way: bucketing
+    only reorders requests (and may hold one back until the batch deadline), which
+    starts paying off once the samples share a batched forward pass.
+    """
+
+    def __init__(self, bucket_size=64, max_dim=None):
+        """
+        Args:
+            bucket_size: int size in pixels of one bucket step along each image axis.
+            max_dim: int or None, if set images are downscaled to fit within (max_dim, max_dim) before bucketing.
+        """
+        self.bucket_size = bucket_size
+        self.max_dim = max_dim
+        self._buckets = {} # bucket key -> list of pending (arrival time, entry) pairs, in arrival order
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._buckets.values())
+
+    def bucket_key(self, image):
+        """
+        Args:
+            image: PIL Image.
+
+        Returns:
+            tuple: (height bucket, width bucket) of the image.
+        """
+        width, height = image.size
+        return round(height / self.bucket_size), round(width / self.bucket_size)
+
+    def add(self, entry, arrival):
+        """
+        Adds a pending (image, prompt, options, future) entry to the bucket of its image.
+
+        Args:
+            entry: (image, prompt, options, future) tuple.
+            arrival: float event loop time at which the request was enqueued.
+        """
+        image, prompt, options, future = entry
+        if self.max_dim is not None and max(image.size) > self.max_dim:
+            image = image.copy() # Don't resize the caller's image in place
+            image.thumbnail((self.max_dim, self.max_dim))
+            entry = (image, prompt, options, future)
+        self._buckets.setdefault(self.bucket_key(image), []).append((arrival, entry))
+
+    def oldest_arrival(self):
+        """
+        Returns:
+            float or None: Arrival time of the oldest pending entry, or None if nothing is pending.
+        """
+        return min((entries[0][0] for entries in self._buckets.values()), default=None)
+
+    def has_full_bucket(self, max_batch_size):
+        """
+        Returns:
+            bool: Whether any bucket holds at least ``max_batch_size`` entries.
+        """
+        return any(len(entries) >= max_batch_size for entries in self._buckets.values())
+
+    def pop_batch(self, max_batch_size):
+        """
+        Removes and returns the next batch.
+
+        The bucket holding the oldest pending entry is always flushed, so a request is
+        never held back behind newer ones, even when another bucket has filled up.
+
+        Args:
+            max_batch_size: int maximum number of entries in the batch.
+
+        Returns:
+            list: Pending (image, prompt, options, future) entries from a single bucket.
+        """
+        if not self._buckets:
+            return []
+        key = min(self._buckets, key=lambda key: self._buckets[key][0][0]) # Earliest arrival across buckets
+        entries = self._buckets.pop(key)
+        if len(entries) > max_batch_size:
+            self._buckets[key] = entries[max_batch_size:]
+        return [entry for _, entry in entries[:max_batch_size]]
+
+
+class AsyncBatchQueue:
+    """
+    Collects inbound (image, prompt, options) requests and hands them to ``process_batch`` in batches.
+
+    Requests are gathered until a bucket of similarly sized images holds
+    ``max_batch_size`` of them or ``timeout`` seconds have passed, and each batch is
+    taken from a single bucket of the ``AdaptiveBatchCollator``. Batches are processed on the
+    queue's own event loop thread, so the web server's event loop is never blocked
+    by generation, and each request's future is resolved as soon as its own result is ready.
+    """
+
+    def __init__(self, process_batch, max_batch_size=8, timeout=0.05, collator=None):
+        """
+        Args:
+            process_batch: callable taking a list of (image, prompt, options) requests and an ``on_result(index, result)``
+                callback, and returning one result per request. Calling ``on_result`` as each request finishes resolves its
+                future without waiting for the rest of the batch. A result that is an Exception is raised from that request's future.
+            max_batch_size: int maximum number of requests per batch.
+            timeout: float seconds to wait for a batch to fill once its first request arrived.
+            collator: AdaptiveBatchCollator or None, groups pending requests by image size.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.collator = collator if collator is not None else AdaptiveBatchCollator()
+        self._loop = None
+        self._queue = None
+
+    def start(self):
+        """
+        Starts ``process_loop`` on a background event loop thread.
+        """
+        if self._loop is not None: # Already running
+            return
+        self._loop = asyncio.new_event_loop()
+        self._queue = asyncio.Queue()
+        thread = threading.Thread(
+            target=self._loop.run_until_complete, args=(self.process_loop(),), name="batch-queue", daemon=True
+        )
+        thread.start()
+
+    def add_request(self, image, prompt, **options):
+        """
+        Enqueues a request for the next batch.
+
+        Args:
+            image: PIL Image of the request.
+            prompt: str prompt with the chat template applied.
+            **options: per-request options handed to ``process_batch`` as a dict.
+
+        Returns:
+            asyncio.Future: Resolved with the result for this request.
+        """
+        if self._loop is None:
+            raise RuntimeError("AsyncBatchQueue.start() must be called before add_request().")
+        future = concurrent.futures.Future()
+        # loop.time() is a monotonic clock read, safe to call from the caller's thread
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (self._loop.time(), (image, prompt, options, future)))
+        return asyncio.wrap_future(future)
+
+    async def _collect_batch(self):
+        """
+        Waits for a request if none is pending, then gathers more until a bucket is full or the timeout expires.
+
+        The timeout runs from the arrival of the oldest pending request, so requests left
+        over from an earlier batch are flushed right away instead of waiting another timeout.
+
+        Returns:
+            list: (image, prompt, options, future) entries whose requests were not cancelled.
+        """
+        if not len(self.collator):
+            arrival, entry = await self._queue.get()
+            self.collator.add(entry, arrival)
+        deadline = self.collator.oldest_arrival() + self.timeout
+        while not self.collator.has_full_bucket(self.max_batch_size):
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                arrival, entry = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            self.collator.add(entry, arrival)
+        batch = self.collator.pop_batch(self.max_batch_size)
+        # Drop requests whose callers went away while waiting
+        return [entry for entry in batch if entry[3].set_running_or_notify_cancel()]
+
+    async def process_loop(self):
+        """
+        Runs batches forever, demultiplexing each batch's results back to the request futures.
+        """
+        while True:
+            batch = await self._collect_batch()
+            if not batch:
+                continue
+            logging.info(f"Processing batch of {len(batch)} request(s)") # Log batch size
+            try:
+                results = await asyncio.to_thread(
+                    self.process_batch, [entry[:3] for entry in batch], functools.partial(self._resolve, batch)
+                )
+            except Exception as e:
+                logging.error(f"Error processing batch: {e}") # Log batch-level errors
+                results = [e] * len(batch)
+            for index, result in enumerate(results):
+                self._resolve(batch, index, result) # No-op for requests already resolved through on_result
+
+    @staticmethod
+    def _resolve(batch, index, result):
+        """
+        Sets the result (or exception) of one request's future, unless it is already resolved.
+
+        Args:
+            batch: list of (image, prompt, options, future) entries.
+            index: int position of the request in the batch.
+            result: result for the request, or the Exception raised while processing it.
+        """
+        future = batch[index][3]
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
@@ -0,0 +1,68 @@
+"""
+Prefix KV-cache reuse for repeated (prompt, image) requests.
+"""
+import dataclasses
+import logging
+from collections import OrderedDict
+
+import mlx.core as mx
+from mlx_vlm.models.base import KVCache
+
+
+class PrefixCachedModel:
+    """
+    Wraps an mlx-vlm model and reuses the prefill of identical (prompt, image) requests.
+
+    ``generate_step`` forwards extra keyword arguments to the model's prefill call, so
+    callers pass ``prefix_key=(prompt, image digest)`` through ``generate_step`` or
+    ``stream_generate``. On a miss the prefill runs and the filled KV cache is stored;
+    on a hit the stored KV cache is copied into the fresh cache and the prefill,
+    vision encoder included, is skipped. Every other attribute is delegated to the
+    wrapped model.
+
+    Not thread-safe: generation is serialized by the batch queue.
+    """
+
+    def __init__(self, model, max_entries=8):
+        """
+        Args:
+            model: mlx-vlm model.
+            max_entries: int maximum number of cached prefixes, least recently used are evicted first.
+        """
+        self.model = model
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # prefix key -> (KV cache snapshot, prefill output)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __call__(self, input_ids, pixel_values, cache=None, prefix_key=None, **kwargs):
+        if prefix_key is None or cache is None or not all(isinstance(c, KVCache) for c in cache):
+            return self.model(input_ids, pixel_values, cache=cache, **kwargs)
+
+        entry = self._entries.get(prefix_key)
+        if entry is not None:
+            self._entries.move_to_end(prefix_key)
+            snapshot, outputs = entry
+            for c, (keys, values, offset) in zip(cache, snapshot):
+                # KVCache reallocates on its next update since the snapshot is exactly full,
+                # so the stored arrays are never written to
+                c.keys, c.values, c.offset = keys, values, offset
+            logging.info("Reusing cached prefill") # Log prefix cache hit
+            return outputs
+
+        outputs = self.model(input_ids, pixel_values, cache=cache, **kwargs)
+        snapshot = [(c.keys[..., : c.offset, :], c.values[..., : c.offset, :], c.offset) for c in cache]
+        # Only the last position's logits are read after the prefill
+        self._entries[prefix_key] = (snapshot, dataclasses.replace(outputs, logits=outputs.logits[:, -1:, :]))
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False) # Evict the least recently used prefix
+            mx.metal.clear_cache() # Return the evicted buffers to the system
+        return outputs
+
+    def clear(self):
+        """
+        Drops all cached prefixes.
+        """
+        self._entries.clear()
+        mx.metal.clear_cache()
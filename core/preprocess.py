@@ -0,0 +1,156 @@
+"""
+Idefics3 (SmolDocling) image preprocessing in MLX ops.
+
+Mirrors the resize, split and normalization of the Hugging Face Idefics3 processor,
+but tiles and normalizes the decoded image directly as an ``mx.array`` instead of
+going through the processor's numpy pipeline.
+"""
+import math
+
+import mlx.core as mx
+import numpy as np
+
+
+def supports_processor(processor):
+    """
+    Args:
+        processor: mlx-vlm processor.
+
+    Returns:
+        bool: Whether the processor is an Idefics3-style processor this module can stand in for.
+    """
+    image_processor = getattr(processor, "image_processor", None)
+    return (
+        all(hasattr(processor, name) for name in ("image_seq_len", "image_token", "fake_image_token", "global_image_tag"))
+        and hasattr(image_processor, "max_image_size")
+        and hasattr(image_processor, "size")
+    )
+
+
+def _rescaled_size(height, width, max_len):
+    """
+    Size with the longest edge scaled to ``max_len``, keeping the aspect ratio (other edge rounded up to even).
+    """
+    aspect_ratio = width / height
+    if width >= height:
+        width = max_len
+        height = int(width / aspect_ratio)
+        height += height % 2
+    else:
+        height = max_len
+        width = int(height * aspect_ratio)
+        width += width % 2
+    return max(height, 1), max(width, 1)
+
+
+def _vision_encoder_size(height, width, tile_size):
+    """
+    Size rounded up to multiples of ``tile_size``, keeping the aspect ratio.
+    """
+    aspect_ratio = width / height
+    if width >= height:
+        width = math.ceil(width / tile_size) * tile_size
+        height = math.ceil(int(width / aspect_ratio) / tile_size) * tile_size
+    else:
+        height = math.ceil(height / tile_size) * tile_size
+        width = math.ceil(int(height * aspect_ratio) / tile_size) * tile_size
+    return height, width
+
+
+def preprocess_image(image_processor, pil_image, dtype=mx.bfloat16):
+    """
+    Resizes, tiles and normalizes an image for the Idefics3 vision encoder.
+
+    Args:
+        image_processor: Idefics3 image processor, read for its sizes, resampling and normalization settings.
+        pil_image: RGB PIL Image.
+        dtype: mx.Dtype of the returned pixel values.
+
+    Returns:
+        tuple: Pixel values (mx.array of shape (frames, 3, tile, tile)), tile rows (int), tile columns (int).
+            Rows and columns are 0 when the image is not split.
+    """
+    tile_size = image_processor.max_image_size["longest_edge"]
+    resample = image_processor.resample
+
+    width, height = pil_image.size
+    height, width = _rescaled_size(height, width, image_processor.size["longest_edge"])
+    image = pil_image.resize((width, height), resample)
+
+    if image_processor.do_image_splitting:
+        height, width = _vision_encoder_size(height, width, tile_size)
+        image = image.resize((width, height), resample)
+    else:
+        height = width = tile_size
+        image = image.resize((width, height), resample)
+
+    pixels = mx.array(np.asarray(image)) # (height, width, 3) uint8
+    if height > tile_size or width > tile_size:
+        rows, cols = height // tile_size, width // tile_size
+        # Row-major tiles via a reshape instead of cropping one by one
+        tiles = pixels.reshape(rows, tile_size, cols, tile_size, 3).transpose(0, 2, 1, 3, 4)
+        tiles = tiles.reshape(rows * cols, tile_size, tile_size, 3)
+        global_image = mx.array(np.asarray(image.resize((tile_size, tile_size), resample)))
+        frames = mx.concatenate([tiles, global_image[None]], axis=0)
+    else:
+        rows = cols = 0
+        frames = pixels[None]
+
+    mean = mx.array(image_processor.image_mean, dtype=mx.float32)
+    std = mx.array(image_processor.image_std, dtype=mx.float32)
+    frames = (frames.astype(mx.float32) * image_processor.rescale_factor - mean) / std
+    return frames.transpose(0, 3, 1, 2).astype(dtype), rows, cols # Channel-first, as the processor returns
+
+
+def _image_prompt(processor, rows, cols):
+    """
+    Expands one image placeholder into the tile and global image tokens the processor would insert.
+    """
+    fake_token = str(getattr(processor.fake_image_token, "content", processor.fake_image_token))
+    image_token = str(getattr(processor.image_token, "content", processor.image_token))
+    global_token = str(getattr(processor.global_image_tag, "content", processor.global_image_tag))
+    image_tokens = image_token * processor.image_seq_len
+    global_prompt = f"{fake_token}{global_token}{image_tokens}{fake_token}"
+    if rows == 0 and cols == 0:
+        return global_prompt
+    prompt = ""
+    for row in range(rows):
+        for col in range(cols):
+            prompt += f"{fake_token}<row_{row + 1}_col_{col + 1}>{image_tokens}"
+        prompt += "\n"
+    return f"{prompt}\n{global_prompt}"
+
+
+def prepare_model_inputs(processor, formatted_prompt, pil_images, dtype=mx.bfloat16):
+    """
+    Builds model inputs for one prompt, stacking the frames of all its images along axis 0.
+
+    Args:
+        processor: Idefics3 processor (see ``supports_processor``).
+        formatted_prompt: str prompt with the chat template applied, one image token per image.
+        pil_images: list of RGB PIL Images.
+        dtype: mx.Dtype of the pixel values.
+
+    Returns:
+        dict: ``input_ids`` (1, tokens), ``pixel_values`` (1, frames, 3, tile, tile) and ``attention_mask`` (1, tokens).
+    """
+    image_token = str(getattr(processor.image_token, "content", processor.image_token))
+    prompt_chunks = formatted_prompt.split(image_token)
+    if len(prompt_chunks) - 1 != len(pil_images):
+        raise ValueError(
+            f"Found {len(prompt_chunks) - 1} {image_token} tokens in the prompt but {len(pil_images)} images."
+        )
+
+    frames = []
+    prompt = prompt_chunks[0]
+    for pil_image, prompt_chunk in zip(pil_images, prompt_chunks[1:]):
+        pixel_values, rows, cols = preprocess_image(processor.image_processor, pil_image, dtype=dtype)
+        frames.append(pixel_values)
+        prompt += _image_prompt(processor, rows, cols) + prompt_chunk
+
+    input_ids = mx.array([processor.tokenizer(prompt)["input_ids"]])
+    return {
+        "input_ids": input_ids,
+        "pixel_values": mx.concatenate(frames, axis=0)[None],
+        "attention_mask": mx.ones(input_ids.shape, dtype=mx.int32),
+    }
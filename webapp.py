@@ -6,25 +6,47 @@
 #     "mlx-vlm",
 #     "pillow",
 #     "requests",
-#     "beautifulsoup4" # Added dependency for BeautifulSoup
+#     "pybase64" # SIMD-accelerated base64 for embedded HTML images
 # ]
 # ///
-from io import BytesIO
+import asyncio
+import atexit
+import base64
+import functools
+import hashlib
+import html
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 from urllib.parse import urlparse
 import logging  # Import logging
 import os # Import os for path manipulation
+import queue
 import re # Import re for regular expressions
-from bs4 import BeautifulSoup # Import BeautifulSoup for XML parsing
+import shutil
+import tempfile
 
+import pybase64
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image, UnidentifiedImageError
 from docling_core.types.doc import ImageRefMode
-from docling_core.types.doc.document import DocTagsDocument, DoclingDocument
-from mlx_vlm import load, generate
+from docling_core.types.doc.document import DocTagsDocument, DoclingDocument, GroupItem
+from mlx_vlm import load
 from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm.utils import load_config, stream_generate
+from mlx_vlm.utils import generate_step, load_config, prepare_inputs, stream_generate
 import gradio as gr
+import mlx.core as mx
+
+from core.batch_queue import AsyncBatchQueue
+from core.prefix_cache import PrefixCachedModel
+from core.preprocess import prepare_model_inputs, supports_processor
+
+# docling-core base64-encodes every embedded HTML image through the stdlib; route it to the SIMD implementation
+base64.b64encode = pybase64.b64encode
 
 # Set up logging
 logging.basicConfig(level=logging.INFO) # or logging.DEBUG for more verbose output
@@ -33,107 +55,514 @@ logging.basicConfig(level=logging.INFO) # or logging.DEBUG for more verbose outp
 model_path = "ds4sd/SmolDocling-256M-preview-mlx-bf16"
 logging.info(f"Loading model from path: {model_path}") # Log model loading start
 model, processor = load(model_path)
+model = PrefixCachedModel(model, max_entries=8) # Skip the prefill of repeated (prompt, image) requests
 config = load_config(model_path)
+MAX_IMAGE_EDGE = processor.image_processor.size.get("longest_edge", 2048) # Longest image edge the processor resizes to
 logging.info(f"Model loaded successfully.") # Log model loading success
 
+## HTTP session - Reuse pooled connections for image URLs instead of a new TCP+TLS handshake per request
+_HTTP = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=2, backoff_factor=0.2))
+_HTTP.mount("https://", _HTTP_ADAPTER)
+_HTTP.mount("http://", _HTTP_ADAPTER)
+
+
+MAX_BATCH_SIZE = 8 # Maximum number of queued requests handed to the model per batch (decoded one after another)
+BATCH_TIMEOUT = 0.05 # Seconds the batch queue waits for a batch to fill
+DOCTAGS_STOP_STRING = "</doctag>" # Generation stops once the model closes the DocTags document
+STREAM_INTERVAL = 16 # Number of tokens between partial DocTags updates when streaming
+RENDER_CACHE_SIZE = 256 # Number of rendered (Markdown, HTML, plain text) outputs kept in memory
+HTML_PREVIEW_LENGTH = 4096 # Characters of HTML shown inline; the full file is offered as a download
+
+_render_cache = OrderedDict() # (DocTags digest, image digest) -> (Markdown, HTML preview, HTML path, plain text), least recently used first
+_render_cache_lock = threading.Lock() # Post-processing runs in worker threads
+
+_HTML_DIR = Path(tempfile.mkdtemp(prefix="smoldocling-html-")) # Full HTML exports, served by Gradio from the temp dir
+atexit.register(shutil.rmtree, _HTML_DIR, ignore_errors=True) # Don't leave the exports behind after shutdown
+
+_doc_pool = queue.LifoQueue() # Reset DoclingDocuments ready for reuse; most recently released first
+
+_EXPORT_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix="export") # Markdown, HTML and plain text exports run side by side
+
+_TEXT_RE = re.compile(rb'>\s*([^<>\s][^<]*?)\s*(?:<|\Z)') # Stripped text after a tag, up to the next tag or the end of truncated output
+
 
-def process_image_to_docling(image_input, prompt_input):
+def _error_outputs(message):
     """
-    Processes an image to Docling format using the specified model.
+    Builds the output tuple returned when a request fails.
+
+    Args:
+        message: str error message shown in the DocTags box.
+
+    Returns:
+        tuple: Error message (str), "Error" for the Markdown and HTML preview, no HTML file (None) and "Error" for the plain text.
+    """
+    return message, "Error", "Error", None, "Error"
+
+
+def _digest(data):
+    """
+    Args:
+        data: bytes to hash.
+
+    Returns:
+        str: Hex BLAKE2b digest of the data.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _image_digest(pil_image):
+    """
+    Hashes the decoded pixels of an image together with its mode and size.
+
+    Args:
+        pil_image: PIL Image.
+
+    Returns:
+        str: Hex BLAKE2b digest of the image.
+    """
+    image_hash = hashlib.blake2b(f"{pil_image.mode}{pil_image.size}".encode(), digest_size=16)
+    image_hash.update(pil_image.tobytes())
+    return image_hash.hexdigest()
+
+
+@functools.lru_cache(maxsize=32)
+def _format_prompt(prompt_input):
+    """
+    Applies the chat template to a prompt, memoized since most requests use the default prompt.
 
     Args:
-        image_input: PIL Image or str (URL or filepath) of the image.
         prompt_input: str prompt for the model.
 
     Returns:
-        tuple: DocTags output (str), Markdown output (str), HTML output (str), Plain Text Output (str).
+        str: Prompt with the chat template applied for one image.
     """
-    ## Settings - These can be exposed as Gradio parameters if needed
-    SHOW_IN_BROWSER = False # We don't need to show in browser in Gradio, we will return HTML string
+    return apply_chat_template(processor, config, prompt_input, num_images=1)
+
 
+def _decode_image(pil_image):
+    """
+    Decodes an opened image eagerly, in the loading thread rather than inside generation.
+
+    JPEGs are decoded at the smallest DCT scale that still covers the model input,
+    larger images are downscaled once to the processor's longest edge, and the image
+    is converted to RGB here so the processor doesn't redo either step.
+
+    Args:
+        pil_image: PIL Image, possibly not yet decoded.
+
+    Returns:
+        PIL Image: Decoded RGB image.
+    """
+    pil_image.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE)) # No-op for non-JPEG or already decoded images
+    pil_image.load()
+    if max(pil_image.size) > MAX_IMAGE_EDGE:
+        pil_image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.BILINEAR) # Keeps the aspect ratio
+    if pil_image.mode != "RGB":
+        if pil_image.mode in ("RGBA", "LA") or "transparency" in pil_image.info:
+            # Flatten transparency onto white, as the processor's own RGB conversion does
+            pil_image = Image.alpha_composite(Image.new("RGBA", pil_image.size, "white"), pil_image.convert("RGBA"))
+        pil_image = pil_image.convert("RGB")
+    return pil_image
+
+
+_ERRS = { # Image loading error type -> message shown to the user
+    FileNotFoundError: "Error: Image file not found",
+    UnidentifiedImageError: "Error: Could not identify image, please check that it is a valid image",
+    Image.DecompressionBombError: "Error: Image is too large to process", # Subclasses Exception, not OSError
+    requests.exceptions.RequestException: "Error fetching image from URL",
+    urllib3.exceptions.HTTPError: "Error fetching image from URL", # Raised while reading the streamed body
+    OSError: "Error opening image",
+}
+
+
+def _load_image(image_input):
+    """
+    Loads the input image of a single request.
+
+    Args:
+        image_input: PIL Image or str (URL or filepath) of the image.
+
+    Returns:
+        tuple: PIL Image (or None), image filepath for logging (str or None), error message (str or None).
+    """
     pil_image = None # Initialize pil_image to None
     image_filepath = None # To store filepath for logging purposes
 
     ## Prepare input image
     if isinstance(image_input, str): # Assume it's a URL or filepath
-        if urlparse(image_input).scheme != "":  # it is a URL
-            image_filepath = image_input # URL is the filepath for logging in this case
-            try:
-                response = requests.get(image_input, stream=True, timeout=10)
-                response.raise_for_status()
-                pil_image = Image.open(BytesIO(response.content))
-            except requests.exceptions.RequestException as e:
-                logging.error(f"URL Request Error: {e}, URL: {image_input}") # Log URL request errors with URL
-                return f"Error fetching image from URL: {e}", "Error", "Error", "Error" # Handle URL fetch error
-            except UnidentifiedImageError as e:
-                logging.error(f"UnidentifiedImageError from URL: {e}, URL: {image_input}") # Log UnidentifiedImageError with URL
-                return f"Error: Could not identify image from URL: {image_input}. Please check if the URL is a valid image. Details: {e}", "Error", "Error", "Error"
-            except Exception as e:
-                logging.error(f"Error opening image from URL: {e}, URL: {image_input}") # Log other image opening errors with URL
-                return f"Error opening image from URL: {e}", "Error", "Error", "Error" # Handle image opening error
-        else: # assume it's a filepath
-            image_filepath = image_input
-            try:
-                pil_image = Image.open(image_input)
-            except FileNotFoundError:
-                logging.error(f"FileNotFoundError: {image_input}") # Log FileNotFoundError
-                return "Error: Image file not found.", "Error", "Error", "Error"
-            except UnidentifiedImageError as e:
-                logging.error(f"UnidentifiedImageError from File: {e}, Filepath: {image_input}") # Log UnidentifiedImageError with filepath
-                return f"Error: Could not identify image file: {image_input}. Please check if the file is a valid image. Details: {e}", "Error", "Error", "Error"
-            except Exception as e:
-                logging.error(f"Error opening image from filepath: {e}, Filepath: {image_input}") # Log other file opening errors with filepath
-                return f"Error opening image from filepath: {e}", "Error", "Error", "Error"
+        image_filepath = image_input # URL is the filepath for logging in this case
+        try:
+            if urlparse(image_input).scheme != "":  # it is a URL
+                with _HTTP.get(image_input, stream=True, timeout=10) as response: # Return the connection to the pool
+                    response.raise_for_status()
+                    response.raw.decode_content = True # Undo any Content-Encoding while streaming
+                    pil_image = _decode_image(Image.open(response.raw))
+            else: # assume it's a filepath
+                pil_image = _decode_image(Image.open(image_input))
+        except tuple(_ERRS) as e:
+            # Most specific entry wins, e.g. UnidentifiedImageError over OSError
+            message = next(_ERRS[error_type] for error_type in type(e).__mro__ if error_type in _ERRS)
+            logging.error(f"{message}: {e}, Image: {image_input}") # Log image loading errors with URL or filepath
+            logging.debug("Image loading traceback", exc_info=True) # Only formatted when DEBUG is enabled
+            return None, image_filepath, f"{message}: {image_input}. Details: {e}"
     elif isinstance(image_input, Image.Image): # It's a PIL Image object directly from Gradio upload
-        pil_image = image_input
+        pil_image = _decode_image(image_input)
         image_filepath = "<PIL.Image object from upload>" # Indicate it's from upload
     elif image_input is None: # Handle case where no image is input (e.g., user clicks process without uploading)
-        return "Error: No image uploaded.", "Error", "Error", "Error"
+        return None, None, "Error: No image uploaded."
     else:
-        return "Error: Invalid image input type.", "Error", "Error", "Error"
+        return None, None, "Error: Invalid image input type."
 
     if pil_image is None: # Should not happen in normal Gradio usage, but for robustness
-        return "Error: No image loaded internally.", "Error", "Error", "Error"
+        return None, image_filepath, "Error: No image loaded internally."
 
+    return pil_image, image_filepath, None
 
-    # Apply chat template
-    formatted_prompt = apply_chat_template(processor, config, prompt_input, num_images=1)
 
-    ## Generate DocTags output
-    doctags_output = ""
+def _prepare_model_inputs(model, processor, formatted_prompt, images):
+    """
+    Builds the model inputs for one prompt.
+
+    SmolDocling's Idefics3 processor is replaced by the MLX preprocessing of
+    ``core.preprocess``; other processors go through mlx-vlm's ``prepare_inputs``.
+
+    Args:
+        model: mlx-vlm model.
+        processor: mlx-vlm processor.
+        formatted_prompt: str prompt with the chat template applied.
+        images: list of PIL Images.
+
+    Returns:
+        dict: input_ids, pixel_values and attention_mask, plus any extra model inputs.
+    """
+    if supports_processor(processor):
+        return prepare_model_inputs(processor, formatted_prompt, images)
+    return prepare_inputs(processor, images, formatted_prompt, getattr(model.config, "image_token_index", None))
+
+
+def generate_doctags(model, processor, formatted_prompt, images, max_tokens=4096, prefix_key=None):
+    """
+    Generates DocTags for one prompt without streaming.
+
+    Token ids are collected as they are sampled and decoded once at the end, which
+    skips the per-token detokenization and result bookkeeping of ``stream_generate``.
+
+    Args:
+        model: mlx-vlm model.
+        processor: mlx-vlm processor.
+        formatted_prompt: str prompt with the chat template applied.
+        images: list of PIL Images.
+        max_tokens: int maximum number of tokens generated.
+        prefix_key: hashable or None, key under which a PrefixCachedModel reuses the prefill.
+
+    Returns:
+        str: DocTags output.
+    """
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    inputs = _prepare_model_inputs(model, processor, formatted_prompt, images)
+    input_ids = inputs.pop("input_ids")
+    pixel_values = inputs.pop("pixel_values")
+    mask = inputs.pop("attention_mask")
+    stop_token_id = tokenizer.convert_tokens_to_ids(DOCTAGS_STOP_STRING) # DocTags markup is tokenized as single tokens
+
+    token_ids = []
+    for token, _ in generate_step(
+        input_ids, model, pixel_values, mask, max_tokens=max_tokens, prefix_key=prefix_key, **inputs
+    ):
+        if token == tokenizer.eos_token_id:
+            break
+        token_ids.append(token)
+        if token == stop_token_id:
+            break
+    return tokenizer.decode(token_ids)
+
+
+## Warm up - MLX compiles kernels and fills the Metal shader cache lazily, so run one token now instead of on the first user.
+## Goes through generate_doctags so the bf16 preprocessing and generate_step kernels requests use are the ones compiled.
+try:
+    warmup_image = Image.new("RGB", (64, 64), "white")
+    warmup_prompt = apply_chat_template(processor, config, "hi", num_images=1)
+    _ = generate_doctags(model, processor, warmup_prompt, [warmup_image], max_tokens=1)
+    mx.metal.clear_cache() # Release the warmup buffers
+    logging.info("Model warmup done.") # Log warmup completion
+except Exception as e:
+    logging.error(f"Model warmup failed: {e}") # The first request will pay the compile cost instead
+
+
+def batched_stream_generate(
+    model, processor, formatted_prompts, images_list, max_tokens=4096, stream_tokens=None, prefix_keys=None, on_texts=None,
+    on_output=None,
+):
+    """
+    Generates DocTags for a batch of prompts and images on the shared model.
+
+    The Idefics3 forward pass in mlx-vlm assumes a batch size of one (it reads
+    ``pixel_values[0]`` and allocates its KV cache for a single sequence), so the
+    samples are decoded back to back rather than stacked along axis 0.
+
+    Args:
+        model: mlx-vlm model.
+        processor: mlx-vlm processor.
+        formatted_prompts: list of str prompts with the chat template applied.
+        images_list: list of lists of PIL Images, one list per prompt.
+        max_tokens: int maximum number of tokens generated per sample.
+        stream_tokens: list of bool or None, whether each sample is generated token by token with
+            ``stream_generate`` rather than in one pass with ``generate_doctags``. Defaults to one pass.
+        prefix_keys: list of hashable or None, per-sample keys under which a PrefixCachedModel reuses the prefill.
+        on_texts: list of callables or None, called with the partial DocTags every ``STREAM_INTERVAL`` streamed tokens.
+        on_output: callable or None, called with (sample index, output) as soon as each sample finishes.
+
+    Returns:
+        list: DocTags output (str) per sample, or the Exception raised while generating it.
+    """
+    if stream_tokens is None:
+        stream_tokens = [False] * len(formatted_prompts)
+    if prefix_keys is None:
+        prefix_keys = [None] * len(formatted_prompts)
+    if on_texts is None:
+        on_texts = [None] * len(formatted_prompts)
+
+    outputs = []
+    # stream_generate in mlx-vlm 0.1.19 has no stop_strings option: it would be forwarded to the model's
+    # **kwargs and silently ignored, so the stop string is checked here on a rolling tail
+    tail_length = len(DOCTAGS_STOP_STRING) - 1 # Enough to catch a stop string split across tokens
+    for index, (formatted_prompt, images, stream, prefix_key, on_text) in enumerate(zip(
+        formatted_prompts, images_list, stream_tokens, prefix_keys, on_texts
+    )):
+        try:
+            if not stream:
+                output = generate_doctags(
+                    model, processor, formatted_prompt, images, max_tokens=max_tokens, prefix_key=prefix_key
+                )
+            else:
+                chunks = [] # Joined once at the end (and per update) instead of growing a string per token
+                tail = ""
+                inputs = _prepare_model_inputs(model, processor, formatted_prompt, images)
+                for i, token in enumerate(stream_generate(
+                    model,
+                    processor,
+                    formatted_prompt,
+                    images,
+                    max_tokens=max_tokens,
+                    verbose=False,
+                    prefix_key=prefix_key,
+                    input_ids=inputs.pop("input_ids"),
+                    pixel_values=inputs.pop("pixel_values"),
+                    mask=inputs.pop("attention_mask"),
+                    **inputs,
+                )):
+                    chunks.append(token.text)
+                    window = tail + token.text
+                    if DOCTAGS_STOP_STRING in window:
+                        break
+                    tail = window[-tail_length:]
+                    if on_text is not None and i % STREAM_INTERVAL == 0:
+                        on_text("".join(chunks))
+                output = "".join(chunks)
+        except Exception as e:
+            output = e
+        outputs.append(output)
+        if on_output is not None:
+            on_output(index, output) # Hand the sample back before the rest of the batch is decoded
+    return outputs
+
+
+def _generate_doctags_batch(requests, on_result=None):
+    """
+    Runs a batch collected by the batch queue through the model.
+
+    Args:
+        requests: list of (PIL Image, formatted prompt, options) requests.
+        on_result: callable or None, called with (request index, output) as soon as each request finishes.
+
+    Returns:
+        list: DocTags output (str) per request, or the Exception raised while generating it.
+    """
+    return batched_stream_generate(
+        model,
+        processor,
+        [formatted_prompt for _, formatted_prompt, _ in requests],
+        [[pil_image] for pil_image, _, _ in requests],
+        max_tokens=4096,
+        stream_tokens=[options.get("stream_tokens", False) for _, _, options in requests],
+        prefix_keys=[options.get("prefix_key") for _, _, options in requests],
+        on_texts=[options.get("on_text") for _, _, options in requests],
+        on_output=on_result,
+    )
+
+
+batch_queue = AsyncBatchQueue(_generate_doctags_batch, max_batch_size=MAX_BATCH_SIZE, timeout=BATCH_TIMEOUT)
+
+
+def _extract_text(doctags_output):
+    """
+    Extracts plain text from DocTags.
+
+    Scans the text between tags with a compiled regex instead of building a full
+    XML tree. Output cut off at ``max_tokens`` keeps its trailing text node.
+
+    Args:
+        doctags_output: str DocTags generated by the model.
+
+    Returns:
+        str: Text of the DocTags, one text node per line.
+    """
+    return '\n'.join(html.unescape(m.group(1).decode()) for m in _TEXT_RE.finditer(doctags_output.encode()))
+
+
+def _acquire_doc():
+    """
+    Returns:
+        DoclingDocument: An empty document, reused from the pool when one is available.
+    """
     try:
-        logging.info(f"Generating DocTags for image: {image_filepath}") # Log generation start with filepath
-        for token in stream_generate(
-            model, processor, formatted_prompt, [pil_image], max_tokens=4096, verbose=False
-        ):
-            doctags_output += token.text
-            if "</doctag>" in token.text:
-                break
-        logging.info(f"DocTags generation complete for image: {image_filepath}") # Log generation complete
-    except Exception as e:
-        logging.error(f"Error during model generation: {e}, Image: {image_filepath}") # Log model generation errors with filepath
-        return f"Error during model generation: {e}", "Error", "Error", "Error"
+        return _doc_pool.get_nowait()
+    except queue.Empty:
+        return DoclingDocument(name="SampleDocument")
 
 
-    # Populate document
+def _release_doc(doc):
+    """
+    Empties a document and returns it to the pool.
+
+    Args:
+        doc: DoclingDocument from ``_acquire_doc``.
+    """
+    for value in vars(doc).values(): # Raw field values, without tripping deprecated field warnings
+        if isinstance(value, (list, dict)):
+            value.clear() # Item lists and pages
+        elif isinstance(value, GroupItem):
+            value.children.clear() # Body and furniture roots
+    _doc_pool.put(doc)
+
+
+def _postprocess(doctags_output, pil_image, image_filepath, image_digest):
+    """
+    Converts DocTags output to Docling and exports it.
+
+    Exports are cached on the DocTags and the image (the HTML embeds the image),
+    so retries and duplicate uploads skip the whole render pipeline. The HTML,
+    which can run to megabytes of embedded images, is written to a file and only
+    a preview is returned inline, keeping it out of Gradio's JSON payload.
+
+    Args:
+        doctags_output: str DocTags generated by the model.
+        pil_image: PIL Image the DocTags were generated from.
+        image_filepath: str image filepath for logging.
+        image_digest: str digest of the image from ``_image_digest``.
+
+    Returns:
+        tuple: DocTags output (str), Markdown output (str), HTML preview (str), HTML file path (str), Plain Text Output (str).
+    """
+    cache_key = (_digest(doctags_output.encode()), image_digest)
+    with _render_cache_lock:
+        cached_outputs = _render_cache.get(cache_key)
+        if cached_outputs is not None:
+            _render_cache.move_to_end(cache_key)
+    if cached_outputs is not None:
+        logging.info(f"Reusing cached exports for image: {image_filepath}") # Log render cache hit
+        return (doctags_output, *cached_outputs)
+
+    # create a docling document - pooled, so bursts don't allocate a fresh tree per request
+    doc = _acquire_doc()
     try:
-        doctags_doc = DocTagsDocument.from_doctags_and_image_pairs([doctags_output], [pil_image])
-        # create a docling document
-        doc = DoclingDocument(name="SampleDocument")
-        doc.load_from_doctags(doctags_doc)
-    except Exception as e:
-        logging.error(f"Error processing DocTags output: {e}, Image: {image_filepath}") # Log DocTags processing errors with filepath
-        return f"Error processing DocTags output: {e}", "Error", "Error", "Error"
+        # Populate document
+        try:
+            doctags_doc = DocTagsDocument.from_doctags_and_image_pairs([doctags_output], [pil_image])
+            doc.load_from_doctags(doctags_doc)
+        except Exception as e:
+            logging.error(f"Error processing DocTags output: {e}, Image: {image_filepath}") # Log DocTags processing errors with filepath
+            return _error_outputs(f"Error processing DocTags output: {e}")
+
+        ## Export as formats - independent of each other, so wall-clock is the slowest export rather than the sum
+        markdown_future = _EXPORT_POOL.submit(doc.export_to_markdown)
+        html_future = _EXPORT_POOL.submit(doc.export_to_html, image_mode=ImageRefMode.EMBEDDED)
+        plain_text_future = _EXPORT_POOL.submit(_extract_text, doctags_output)
+        wait([markdown_future, html_future, plain_text_future]) # Even if one fails, the others still read the document
+        markdown_output, html_output, plain_text_output = (
+            markdown_future.result(), html_future.result(), plain_text_future.result()
+        )
+    finally:
+        _release_doc(doc) # Every export has finished with the document (or failed)
+
+    html_path = _HTML_DIR / f"{cache_key[0]}-{cache_key[1]}.html"
+    # Write to a private file and rename it into place, so concurrent identical requests never see a partial file
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=_HTML_DIR, prefix=".", suffix=".html", delete=False
+    ) as html_file:
+        html_file.write(html_output)
+    os.replace(html_file.name, html_path)
+    html_preview = html_output[:HTML_PREVIEW_LENGTH]
+    if len(html_output) > HTML_PREVIEW_LENGTH:
+        html_preview += "\n<!-- Preview truncated, download the HTML file for the full output -->"
+
+    with _render_cache_lock:
+        _render_cache[cache_key] = (markdown_output, html_preview, str(html_path), plain_text_output)
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            _, evicted_outputs = _render_cache.popitem(last=False) # Evict the least recently used entry
+            Path(evicted_outputs[2]).unlink(missing_ok=True)
 
-    ## Export as formats
-    markdown_output = doc.export_to_markdown()
-    html_output = doc.export_to_html(image_mode=ImageRefMode.EMBEDDED)
+    return doctags_output, markdown_output, html_preview, str(html_path), plain_text_output
 
-    # Extract plain text from doctags_output using BeautifulSoup
-    soup = BeautifulSoup(doctags_output, 'xml') # Parse as XML
-    plain_text_output = soup.get_text(separator='\n', strip=True) # Get text, separated by newlines, and stripped
 
-    return doctags_output, markdown_output, html_output, plain_text_output
+async def process_image_to_docling(image_input, prompt_input, stream_tokens):
+    """
+    Processes an image to Docling format using the specified model.
+
+    Generation is delegated to the batch queue, which groups concurrent requests for the shared model.
+    With token streaming the partial DocTags are yielded as they are generated;
+    the Docling exports are only computed for the final output.
+
+    Args:
+        image_input: PIL Image or str (URL or filepath) of the image.
+        prompt_input: str prompt for the model.
+        stream_tokens: bool, whether partial DocTags are shown while generating.
+
+    Yields:
+        tuple: DocTags output (str), Markdown output (str), HTML preview (str), HTML file path (str or None), Plain Text Output (str).
+    """
+    ## Settings - These can be exposed as Gradio parameters if needed
+    SHOW_IN_BROWSER = False # We don't need to show in browser in Gradio, we will return an HTML file
+
+    pil_image, image_filepath, error = await asyncio.to_thread(_load_image, image_input) # Keep the event loop free
+    if error is not None:
+        yield _error_outputs(error)
+        return
+    # Hash the image once; it keys both the prefill and the render caches
+    image_digest = await asyncio.to_thread(_image_digest, pil_image)
+    # Apply chat template
+    formatted_prompt = _format_prompt(prompt_input)
+
+    ## Generate DocTags output
+    logging.info(f"Generating DocTags for image: {image_filepath}") # Log generation start with filepath
+    updates = asyncio.Queue() # Partial DocTags pushed from the generation thread, then None once done
+    loop = asyncio.get_running_loop()
+    future = batch_queue.add_request(
+        pil_image,
+        formatted_prompt,
+        stream_tokens=stream_tokens,
+        prefix_key=(formatted_prompt, image_digest),
+        on_text=functools.partial(loop.call_soon_threadsafe, updates.put_nowait) if stream_tokens else None,
+    )
+    future.add_done_callback(lambda _: updates.put_nowait(None))
+    try:
+        while (partial_doctags := await updates.get()) is not None:
+            yield partial_doctags, "", "", None, ""
+
+        try:
+            doctags_output = await future
+        except Exception as e:
+            logging.error(f"Error during model generation: {e}, Image: {image_filepath}") # Log model generation errors with filepath
+            yield _error_outputs(f"Error during model generation: {e}")
+            return
+        logging.info(f"DocTags generation complete for image: {image_filepath}") # Log generation complete
+
+        yield await asyncio.to_thread(
+            _postprocess, doctags_output, pil_image, image_filepath, image_digest
+        ) # Keep the event loop free
+    finally:
+        future.cancel() # A disconnected client must not leave its request queued for the GPU
 
 
 if __name__ == "__main__":
@@ -143,19 +572,27 @@ if __name__ == "__main__":
             with gr.Column():
                 image_input = gr.Image(type="pil", label="Input Image", sources=["upload", "webcam", "clipboard"])
                 prompt_input = gr.Textbox(value="Convert this page to docling.", label="Prompt")
+                stream_tokens_input = gr.Checkbox(value=False, label="Stream tokens")
                 process_button = gr.Button("Process Image")
             with gr.Column():
                 doctags_output_box = gr.Code(label="DocTags Output", language="html") # Changed language to "html"
                 markdown_output_box = gr.Code(label="Markdown Output", language="markdown")
-                html_output_box = gr.Code(label="HTML Output", language="html")
+                html_output_box = gr.Code(label="HTML Output (Preview)", language="html")
+                html_file_box = gr.File(label="HTML File")
                 plain_text_output_box = gr.Code(label="Plain Text Output") # Added Textbox for plain text
                 #gr.Markdown("Download button for Plain Text Output requires a newer version of Gradio.") # Informative message
 
 
         process_button.click(
             process_image_to_docling,
-            inputs=[image_input, prompt_input],
-            outputs=[doctags_output_box, markdown_output_box, html_output_box, plain_text_output_box] # Added plain_text_output_box
+            inputs=[image_input, prompt_input, stream_tokens_input],
+            outputs=[doctags_output_box, markdown_output_box, html_output_box, html_file_box, plain_text_output_box], # Added plain_text_output_box
+            api_name="process_image",
+            show_progress="minimal", # Partial DocTags are shown while streaming
+            concurrency_id="gpu", # Events sharing the model are limited together
+            concurrency_limit=MAX_BATCH_SIZE, # The batch queue serializes model access, so let a full batch in at once
         )
 
+    batch_queue.start()
+    demo.queue(default_concurrency_limit=1, max_size=64) # Events run one at a time unless they opt in; bound the backlog
     demo.launch() # Removed private=True, local access is default. If needed use share=False
\ No newline at end of file